@@ -1,8 +1,26 @@
+import asyncio
+import collections
+import dataclasses
 import datetime
+import functools
+import itertools
 import logging
+import operator
 import os
+import re
 from enum import Enum
-from typing import Dict, List, Optional
+from typing import (
+    AsyncGenerator,
+    AsyncIterator,
+    Counter,
+    Dict,
+    FrozenSet,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
 
 import discord
 from discord import app_commands
@@ -14,11 +32,13 @@ from discord_ext_commands_coghelper.utils import (
     get_list,
     get_bool,
     get_before_after_fmts,
-    get_corrected_before_after_str,
 )
 
 logger = logging.getLogger(__name__)
 
+# <:name:id> / <a:name:id> 形式のカスタム絵文字
+_CUSTOM_EMOJI_RE = re.compile(r"<(a?):([A-Za-z0-9_]+):(\d+)>")
+
 
 class _SortOrder(Enum):
     ASCENDING = 1
@@ -33,19 +53,18 @@ class _SortOrder(Enum):
         return True if value == _SortOrder.DESCENDING else False
 
 
-class _EmojiCountType(Enum):
-    MESSAGE_CONTENT = 1
-    MESSAGE_REACTION = 2
-
-
 class _EmojiCounter:
     def __init__(self, emoji: discord.Emoji):
         self._emoji = emoji
         self._rank = 0
-        self._counts = {t: 0 for t in _EmojiCountType}
+        self.content_count = 0
+        self.reaction_count = 0
+        self._total = 0
 
-    def increment(self, count_type: _EmojiCountType):
-        self._counts[count_type] += 1
+    def add_counts(self, content_count: int, reaction_count: int):
+        self.content_count += content_count
+        self.reaction_count += reaction_count
+        self._total += content_count + reaction_count
 
     @property
     def emoji(self) -> discord.Emoji:
@@ -60,16 +79,227 @@ class _EmojiCounter:
         self._rank = value
 
     @property
-    def content_count(self) -> int:
-        return self._counts[_EmojiCountType.MESSAGE_CONTENT]
+    def total_count(self) -> int:
+        return self._total
+
+
+class _ReactionSummary:
+    __slots__ = ("emoji_id", "count", "humans", "bots")
+
+    def __init__(self, emoji_id: int, count: int, resolved: bool = False):
+        self.emoji_id = emoji_id
+        self.count = count
+        # 付けたユーザーのID (取得していなければNone)
+        self.humans: Optional[Set[int]] = set() if resolved else None
+        self.bots: Optional[Set[int]] = set() if resolved else None
 
     @property
-    def reaction_count(self) -> int:
-        return self._counts[_EmojiCountType.MESSAGE_REACTION]
+    def is_resolved(self) -> bool:
+        return self.humans is not None
+
+    async def resolve(self, reaction: discord.Reaction):
+        self.humans = set()
+        self.bots = set()
+        async for user in reaction.users():
+            (self.bots if user.bot else self.humans).add(user.id)
+
+    def add_user(self, user_id: int, bot: bool):
+        self.count += 1
+        if self.is_resolved:
+            (self.bots if bot else self.humans).add(user_id)
+
+    def remove_user(self, user_id: int):
+        self.count -= 1
+        if self.is_resolved:
+            self.humans.discard(user_id)
+            self.bots.discard(user_id)
+
+    def has_user(self, user_ids: Set[int], contains_bot: bool) -> bool:
+        # 集合演算で判定し、ユーザーごとのループを避ける
+        if not self.is_resolved:
+            return False
+        if user_ids:
+            if not self.humans.isdisjoint(user_ids):
+                return True
+            return contains_bot and not self.bots.isdisjoint(user_ids)
+        return bool(self.humans) or (contains_bot and bool(self.bots))
+
+
+def _exceeds(reaction_count: int, bot_count: Optional[int]) -> bool:
+    # サーバー内のBOT数より多く付いたリアクションは、BOT以外も付けているとみなす
+    # (既にサーバーを抜けたBOTのリアクションは数えられないので近似であり、それは許容する)
+    return bot_count is not None and reaction_count > bot_count
+
+
+class _MessageSummary:
+    __slots__ = ("id", "author_id", "author_bot", "emoji_ids", "reactions")
+
+    def __init__(
+        self,
+        message_id: int,
+        author_id: Optional[int],
+        author_bot: bool,
+        emoji_ids: FrozenSet[int],
+        reactions: Dict[int, _ReactionSummary],
+    ):
+        self.id = message_id
+        self.author_id = author_id
+        self.author_bot = author_bot
+        self.emoji_ids = emoji_ids
+        # 絵文字ID -> リアクション (1メッセージに同じ絵文字のリアクションは1つ)
+        self.reactions = reactions
+
+    @staticmethod
+    async def from_message(
+        message: discord.Message,
+        resolve_ids: Set[int],
+        bot_count: Optional[int] = None,
+    ) -> "_MessageSummary":
+        emoji_ids = frozenset(
+            int(match.group(3)) for match in _CUSTOM_EMOJI_RE.finditer(message.content)
+        )
+        reactions = {}
+        for reaction in message.reactions:
+            if not reaction.is_custom_emoji():
+                continue
+            summary = _ReactionSummary(reaction.emoji.id, reaction.count)
+            # 誰が付けたかは必要な絵文字についてだけ取得する
+            if reaction.emoji.id in resolve_ids and not _exceeds(
+                reaction.count, bot_count
+            ):
+                await summary.resolve(reaction)
+            reactions[summary.emoji_id] = summary
+        return _MessageSummary(
+            message.id, message.author.id, message.author.bot, emoji_ids, reactions
+        )
 
     @property
-    def total_count(self) -> int:
-        return sum(self._counts.values())
+    def is_empty(self) -> bool:
+        return not self.emoji_ids and not self.reactions
+
+
+class _ChannelHistory:
+    """取得済みのメッセージID範囲(after_id < id < before_id)と、
+    その範囲内でカスタム絵文字が使われたメッセージの要約を保持する"""
+
+    def __init__(self):
+        self._after_id: Optional[int] = None
+        self._before_id: Optional[int] = None
+        self._messages: Dict[int, _MessageSummary] = {}
+        # append()で受け取った最新のメッセージID (チャンネルの最終メッセージ)
+        self._last_message_id: Optional[int] = None
+        # 取得中の範囲と、その間にイベントが起きて取り直しが必要なメッセージID
+        self._fetching: List[Tuple[int, int]] = []
+        self._dirty: Set[int] = set()
+
+    def _is_connected(self, after_id: int, before_id: int) -> bool:
+        return (
+            self._after_id is not None
+            and after_id < self._before_id
+            and self._after_id < before_id
+        )
+
+    def holes(self, after_id: int, before_id: int) -> List[Tuple[int, int]]:
+        # 取得済みの範囲と繋がらなければ全期間を取り直す
+        if not self._is_connected(after_id, before_id):
+            return [(after_id, before_id)]
+        holes = []
+        if after_id < self._after_id:
+            holes.append((after_id, self._after_id + 1))
+        if self._before_id < before_id:
+            holes.append((self._before_id - 1, before_id))
+        return holes
+
+    def mark_fetched(self, after_id: int, before_id: int):
+        if self._is_connected(after_id, before_id):
+            self._after_id = min(self._after_id, after_id)
+            self._before_id = max(self._before_id, before_id)
+            return
+        # 繋がらない範囲を取得した場合は古い範囲を捨てて置き換える
+        self._messages = {
+            message_id: summary
+            for message_id, summary in self._messages.items()
+            if after_id < message_id < before_id
+        }
+        self._after_id = after_id
+        self._before_id = before_id
+
+    def begin_fetch(self, after_id: int, before_id: int):
+        self._fetching.append((after_id, before_id))
+
+    def end_fetch(self, after_id: int, before_id: int):
+        self._fetching.remove((after_id, before_id))
+        self._dirty = {
+            message_id for message_id in self._dirty if self._is_fetching(message_id)
+        }
+
+    def _is_fetching(self, message_id: int) -> bool:
+        return any(
+            after_id < message_id < before_id for after_id, before_id in self._fetching
+        )
+
+    def touch(self, message_id: int):
+        # 取得中の範囲で起きたイベントは取得結果に反映されていない可能性がある
+        if self._is_fetching(message_id):
+            self._dirty.add(message_id)
+
+    def pop_dirty(self, after_id: int, before_id: int) -> List[int]:
+        message_ids = [
+            message_id
+            for message_id in self._dirty
+            if after_id < message_id < before_id
+        ]
+        self._dirty.difference_update(message_ids)
+        return message_ids
+
+    def covers(self, message_id: int) -> bool:
+        return (
+            self._after_id is not None and self._after_id < message_id < self._before_id
+        )
+
+    def get(self, message_id: int) -> Optional[_MessageSummary]:
+        return self._messages.get(message_id)
+
+    def append(self, summary: _MessageSummary):
+        # 取得済みの範囲が直前の最終メッセージまで届いている場合のみ、
+        # 新着メッセージで範囲を末尾に伸ばす (間に未取得のメッセージがあり得るため)
+        last_message_id = self._last_message_id
+        self._last_message_id = summary.id
+        if (
+            self._after_id is not None
+            and last_message_id is not None
+            and self._before_id > last_message_id
+        ):
+            self._before_id = max(self._before_id, summary.id + 1)
+        if self.covers(summary.id):
+            self.add(summary)
+
+    def add(self, summary: _MessageSummary):
+        if summary.is_empty:
+            self._messages.pop(summary.id, None)
+        else:
+            self._messages[summary.id] = summary
+
+    def discard(self, message_id: int):
+        self._messages.pop(message_id, None)
+
+    def trim(self, max_messages: int):
+        # 古いメッセージから捨て、取得済みの範囲もそれに合わせて縮める
+        # (取得中のメッセージを捨てないよう、取得中は何もしない)
+        if self._fetching or len(self._messages) <= max_messages:
+            return
+        message_ids = sorted(self._messages)
+        dropped_ids = message_ids[: len(message_ids) - max_messages]
+        for message_id in dropped_ids:
+            del self._messages[message_id]
+        self._after_id = max(self._after_id, dropped_ids[-1])
+
+    def messages(self, after_id: int, before_id: int) -> List[_MessageSummary]:
+        return [
+            summary
+            for message_id, summary in self._messages.items()
+            if after_id < message_id < before_id
+        ]
 
 
 class _Constant(Constant):
@@ -79,8 +309,35 @@ class _Constant(Constant):
     DATE_FORMAT_HYPHEN = "%Y-%m-%d"
     DATE_FORMATS = [DATE_FORMAT_SLASH, DATE_FORMAT_HYPHEN]
     DEFAULT_RANK: int = 10
+    MAX_CONCURRENT_CHANNELS: int = 8
+    PREFETCH_MESSAGES: int = 500
+    MAX_CACHED_MESSAGES = int(
+        os.environ.get("DISCORD_EMOJI_RANKING_MAX_CACHED_MESSAGES", 10000)
+    )
+
+
+@dataclasses.dataclass
+class _RankingArgs:
+    channel_ids: List[int] = dataclasses.field(default_factory=list)
+    before: Optional[datetime.datetime] = None
+    after: Optional[datetime.datetime] = None
+    order: _SortOrder = _SortOrder.DESCENDING
+    rank: int = _Constant.DEFAULT_RANK
+    contains_bot: bool = False
+    user_ids: List[int] = dataclasses.field(default_factory=list)
 
 
+def _parse_ids(value: Optional[str], mention_chars: str) -> List[int]:
+    if not value:
+        return []
+    return [int(v.strip().strip(mention_chars)) for v in value.split(",")]
+
+
+# 下1桁ごとの序数の接尾辞 (11-13は例外的に"th")
+_RANK_SUFFIXES = ("th", "st", "nd", "rd", "th", "th", "th", "th", "th", "th")
+
+
+@functools.lru_cache(maxsize=1024)
 def _get_times_str(count: int) -> str:
     if count == 1:
         return "1 time"
@@ -88,13 +345,55 @@ def _get_times_str(count: int) -> str:
 
 
 def _get_rank_str(rank: int) -> str:
-    if rank == 1:
-        return "1st"
-    if rank == 2:
-        return "2nd"
-    if rank == 3:
-        return "3rd"
-    return f"{rank}th"
+    suffix = _RANK_SUFFIXES[rank % 10 if rank % 100 // 10 != 1 else 0]
+    return f"{rank}{suffix}"
+
+
+async def _prefetch(
+    iterator: AsyncGenerator[discord.Message, None], size: int
+) -> AsyncIterator[discord.Message]:
+    # 取得を別タスクで先行させ、集計している間に次のページを取りに行く
+    queue: asyncio.Queue = asyncio.Queue(maxsize=size)
+    done = object()
+
+    async def produce():
+        cancelled = False
+        try:
+            async for item in iterator:
+                await queue.put(item)
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            await iterator.aclose()
+            # 消費側が途中で止まった(キャンセルされた)場合は誰も待っていないので、
+            # 満杯のキューで止まらないよう終了の印は積まない
+            if not cancelled:
+                await queue.put(done)
+
+    task = asyncio.create_task(produce())
+    try:
+        while True:
+            item = await queue.get()
+            if item is done:
+                break
+            yield item
+        # 取得中の例外(権限エラーなど)はここで呼び出し元に伝える
+        await task
+    finally:
+        task.cancel()
+
+
+def _may_have_history(
+    channel: discord.TextChannel, after_id: int, before_id: int
+) -> bool:
+    # チャンネル作成より前のメッセージは存在しない
+    if channel.id >= before_id:
+        return False
+    # 最後のメッセージより後のメッセージは存在しない
+    if channel.last_message_id is not None and channel.last_message_id <= after_id:
+        return False
+    return True
 
 
 class EmojiRanking(commands.Cog, CogHelper):
@@ -103,10 +402,15 @@ class EmojiRanking(commands.Cog, CogHelper):
         self._channel_ids: List[int]
         self._before: Optional[datetime.datetime] = None
         self._after: Optional[datetime.datetime] = None
+        self._before_str = ""
+        self._after_str = ""
         self._order = _SortOrder.DESCENDING
         self._rank = _Constant.DEFAULT_RANK
         self._contains_bot = False
         self._user_ids: List[int] = []
+        self._bot_count: Optional[int] = None
+        self._histories: Dict[int, _ChannelHistory] = {}
+        self._history_semaphore = asyncio.Semaphore(_Constant.MAX_CONCURRENT_CHANNELS)
 
     @app_commands.command(
         name="emoji_ranking",
@@ -146,27 +450,26 @@ class EmojiRanking(commands.Cog, CogHelper):
             invoked = ctx.invoked_with or ""
             remaining = raw_content[len(invoked) :].strip()
             if remaining:
-                args = self._parse_legacy_args(tuple(remaining.split()))
-                await self._run_ranking(ctx, args)
+                self._parse_args(ctx, self._parse_legacy_args(tuple(remaining.split())))
+                await self._execute(ctx)
                 return
 
-        args: Dict[str, str] = {}
-
-        def set_arg(key: str, value):
-            if value is None or value == "":
-                return
-            args[key] = str(value)
-
-        set_arg("channel", channel)
-        set_arg("before", before)
-        set_arg("after", after)
-        set_arg("order", order)
-        if rank is not None:
-            set_arg("rank", rank)
-        if bot is not None:
-            set_arg("bot", bot)
-        set_arg("user", user)
-
+        # 日付だけは文字列で受け取るので、legacy引数と同じ形式で解釈する
+        dates = {
+            key: value for key, value in (("before", before), ("after", after)) if value
+        }
+        before_dt, after_dt = get_before_after_fmts(
+            ctx, dates, *_Constant.DATE_FORMATS, tz=_Constant.TZ
+        )
+        args = _RankingArgs(
+            channel_ids=_parse_ids(channel, "<#>"),
+            before=before_dt,
+            after=after_dt,
+            order=_SortOrder.parse(order or ""),
+            rank=rank if rank is not None else _Constant.DEFAULT_RANK,
+            contains_bot=bool(bot),
+            user_ids=_parse_ids(user, "<@!>"),
+        )
         await self._run_ranking(ctx, args)
 
     def _parse_legacy_args(self, raw_args: tuple) -> Dict[str, str]:
@@ -179,29 +482,51 @@ class EmojiRanking(commands.Cog, CogHelper):
                 parsed[key] = value
         return parsed
 
-    async def _run_ranking(self, ctx: commands.Context, args: Dict[str, str]):
-        self._parse_args(ctx, args)
+    async def _run_ranking(self, ctx: commands.Context, args: _RankingArgs):
+        self._set_args(ctx, args)
         await self._execute(ctx)
 
     def _parse_args(self, ctx: commands.Context, args: Dict[str, str]):
-        self._channel_ids = get_list(args, "channel", ",", lambda value: int(value), [])
-        self._before, self._after = get_before_after_fmts(
+        before, after = get_before_after_fmts(
             ctx, args, *_Constant.DATE_FORMATS, tz=_Constant.TZ
         )
-        self._order = _SortOrder.parse(args.get("order", ""))
-        self._rank = int(args.get("rank", _Constant.DEFAULT_RANK))
-        self._contains_bot = get_bool(args, "bot", False)
-        self._user_ids = get_list(
-            args, "user", ",", lambda value: int(value.strip("<@!>")), []
+        ranking_args = _RankingArgs(
+            channel_ids=get_list(args, "channel", ",", lambda value: int(value), []),
+            before=before,
+            after=after,
+            order=_SortOrder.parse(args.get("order", "")),
+            rank=int(args.get("rank", _Constant.DEFAULT_RANK)),
+            contains_bot=get_bool(args, "bot", False),
+            user_ids=get_list(
+                args, "user", ",", lambda value: int(value.strip("<@!>")), []
+            ),
         )
+        self._set_args(ctx, ranking_args)
+
+    def _set_args(self, ctx: commands.Context, args: _RankingArgs):
+        self._channel_ids = args.channel_ids
+        self._before = args.before
+        self._after = args.after
+        self._order = args.order
+        self._rank = args.rank
+        self._contains_bot = args.contains_bot
+        self._user_ids = args.user_ids
+        # 表示用の期間は指定がなければ現在時刻・サーバー作成日で補う
+        before = self._before or datetime.datetime.now(tz=_Constant.TZ)
+        after = self._after or ctx.guild.created_at.astimezone(_Constant.TZ)
+        self._before_str = before.strftime(_Constant.DATE_FORMAT_SLASH)
+        self._after_str = after.strftime(_Constant.DATE_FORMAT_SLASH)
 
     async def _execute(self, ctx: commands.Context):
         if hasattr(ctx, "interaction") and ctx.interaction:
             if not ctx.interaction.response.is_done():
                 await ctx.interaction.response.defer()
 
-        before = to_utc_naive(self._before)
+        # channel.history()と同じ基準でdatetimeをメッセージIDの範囲に変換する
+        before = to_utc_naive(self._before) or discord.utils.utcnow()
         after = to_utc_naive(self._after)
+        before_id = discord.utils.time_snowflake(before, high=False)
+        after_id = discord.utils.time_snowflake(after, high=True) if after else 0
 
         counters = [_EmojiCounter(emoji) for emoji in ctx.guild.emojis]
 
@@ -215,20 +540,33 @@ class EmojiRanking(commands.Cog, CogHelper):
             for channel in channels
             if channel is not None and isinstance(channel, discord.TextChannel)
         ]
-        for channel in channels:
-            logger.debug(f"count emoji in {channel.name} channel.")
-            try:
-                messages = [
-                    message
-                    async for message in channel.history(
-                        limit=None, before=before, after=after
-                    )
-                ]
-            except discord.Forbidden as e:
-                # BOTに権限がないケースはログを出力して続行
-                logger.warning(f"exception={e}, channel={channel}")
-            else:
-                counters = await self.count_emojis(counters, messages)
+        # メンバー一覧を一度だけ取り揃えておく (Intents.membersが必要)
+        if not ctx.guild.chunked and self.bot.intents.members:
+            await ctx.guild.chunk(cache=True)
+
+        # メンバーが揃っている場合のみBOTの数を確定できる
+        if ctx.guild.chunked:
+            self._bot_count = sum(1 for member in ctx.guild.members if member.bot)
+        else:
+            self._bot_count = None
+
+        # チャンネルごとの履歴取得と集計を並列に実行し、結果を絵文字IDごとに合算する
+        emoji_ids = {counter.emoji.id for counter in counters}
+        results = await asyncio.gather(
+            *(
+                self._scan_channel(channel, after_id, before_id, emoji_ids)
+                for channel in channels
+            )
+        )
+        content_counts: Counter[int] = collections.Counter()
+        reaction_counts: Counter[int] = collections.Counter()
+        for channel_content_counts, channel_reaction_counts in results:
+            content_counts.update(channel_content_counts)
+            reaction_counts.update(channel_reaction_counts)
+        for counter in counters:
+            counter.add_counts(
+                content_counts[counter.emoji.id], reaction_counts[counter.emoji.id]
+            )
 
         rank = max(1, min(self._rank, len(ctx.guild.emojis)))
         sorted_counters = self.sort_ranking(counters, rank)
@@ -238,10 +576,7 @@ class EmojiRanking(commands.Cog, CogHelper):
             title = f"Emoji Usage Ranking Top {rank}"
         else:
             title = f"Emoji Usage Ranking Top {rank} Worst"
-        before_str, after_str = get_corrected_before_after_str(
-            self._before, self._after, ctx.guild, _Constant.TZ, *_Constant.DATE_FORMATS
-        )
-        description_lines = [f"{after_str} ~ {before_str}"]
+        description_lines = [f"{self._after_str} ~ {self._before_str}"]
         if self._user_ids:
             user_names = []
             for user_id in self._user_ids:
@@ -259,43 +594,204 @@ class EmojiRanking(commands.Cog, CogHelper):
         logger.debug("send result")
         await ctx.send(embed=embed)
 
-    async def count_emojis(
-        self, counters: List[_EmojiCounter], messages: List[discord.Message]
-    ) -> List[_EmojiCounter]:
+    async def _scan_channel(
+        self,
+        channel: discord.TextChannel,
+        after_id: int,
+        before_id: int,
+        emoji_ids: Set[int],
+    ) -> Tuple[Counter[int], Counter[int]]:
+        if not _may_have_history(channel, after_id, before_id):
+            # 期間内にメッセージが存在し得ないチャンネルはAPIを叩かない
+            logger.debug(f"skip {channel.name} channel.")
+            return collections.Counter(), collections.Counter()
+        history = self._histories.setdefault(channel.id, _ChannelHistory())
+        # 誰が付けたかで絞り込む場合のみリアクションのユーザーを取得する
+        if self._contains_bot and not self._user_ids:
+            resolve_ids = set()
+        else:
+            resolve_ids = emoji_ids
+        async with self._history_semaphore:
+            logger.debug(f"count emoji in {channel.name} channel.")
+            try:
+                await self._fetch_history(
+                    channel,
+                    history,
+                    after_id,
+                    before_id,
+                    resolve_ids,
+                    self._known_bot_count(),
+                )
+            except discord.Forbidden as e:
+                # BOTに権限がないケースはログを出力して続行
+                logger.warning(f"exception={e}, channel={channel}")
+                return collections.Counter(), collections.Counter()
+        counts = self.count_emojis(history.messages(after_id, before_id), emoji_ids)
+        # 集計し終えてから、チャンネルごとのキャッシュを上限まで古い方から捨てる
+        history.trim(_Constant.MAX_CACHED_MESSAGES)
+        return counts
+
+    async def _fetch_history(
+        self,
+        channel: discord.TextChannel,
+        history: _ChannelHistory,
+        after_id: int,
+        before_id: int,
+        resolve_ids: Set[int],
+        bot_count: Optional[int],
+    ):
+        # キャッシュされていない範囲だけを取得する
+        for hole_after_id, hole_before_id in history.holes(after_id, before_id):
+            # 最後のメッセージより後ろの範囲は取得しなくても空と分かる
+            last_message_id = channel.last_message_id
+            if last_message_id is not None and last_message_id <= hole_after_id:
+                history.mark_fetched(hole_after_id, hole_before_id)
+                continue
+            await self._fetch_range(
+                channel, history, hole_after_id, hole_before_id, resolve_ids, bot_count
+            )
+            history.mark_fetched(hole_after_id, hole_before_id)
+
+        # キャッシュ済みでもリアクションのユーザーが未取得のものは、
+        # 1件ずつではなくその範囲をまとめて(100件/リクエストで)取り直す
+        message_ids = {
+            summary.id
+            for summary in history.messages(after_id, before_id)
+            if any(
+                not reaction.is_resolved
+                and reaction.emoji_id in resolve_ids
+                and not _exceeds(reaction.count, bot_count)
+                for reaction in summary.reactions.values()
+            )
+        }
+        if message_ids:
+            await self._fetch_range(
+                channel,
+                history,
+                min(message_ids) - 1,
+                max(message_ids) + 1,
+                resolve_ids,
+                bot_count,
+                message_ids,
+            )
+
+    async def _fetch_range(
+        self,
+        channel: discord.TextChannel,
+        history: _ChannelHistory,
+        after_id: int,
+        before_id: int,
+        resolve_ids: Set[int],
+        bot_count: Optional[int],
+        message_ids: Optional[Set[int]] = None,
+    ):
+        # message_idsを指定した場合は、範囲内のそのメッセージだけを要約し直す
+        history.begin_fetch(after_id, before_id)
+        try:
+            missing_ids = set(message_ids) if message_ids is not None else set()
+            messages = channel.history(
+                limit=None,
+                before=discord.Object(id=before_id),
+                after=discord.Object(id=after_id),
+            )
+            async for message in _prefetch(messages, _Constant.PREFETCH_MESSAGES):
+                if message_ids is not None and message.id not in message_ids:
+                    continue
+                missing_ids.discard(message.id)
+                history.add(
+                    await _MessageSummary.from_message(message, resolve_ids, bot_count)
+                )
+            # 取り直して見つからなかったメッセージは削除されている
+            for message_id in missing_ids:
+                history.discard(message_id)
+            await self._refetch_dirty(
+                channel, history, after_id, before_id, resolve_ids, bot_count
+            )
+        finally:
+            history.end_fetch(after_id, before_id)
+
+    async def _refetch_dirty(
+        self,
+        channel: discord.TextChannel,
+        history: _ChannelHistory,
+        after_id: int,
+        before_id: int,
+        resolve_ids: Set[int],
+        bot_count: Optional[int],
+    ):
+        # 取得中に編集・削除・リアクションのイベントがあったメッセージを取り直す
+        # (取り直している間のイベントも拾うため、なくなるまで繰り返す)
+        message_ids = history.pop_dirty(after_id, before_id)
+        while message_ids:
+            for message_id in message_ids:
+                try:
+                    message = await channel.fetch_message(message_id)
+                except discord.NotFound:
+                    history.discard(message_id)
+                else:
+                    history.add(
+                        await _MessageSummary.from_message(
+                            message, resolve_ids, bot_count
+                        )
+                    )
+            message_ids = history.pop_dirty(after_id, before_id)
+
+    def count_emojis(
+        self, summaries: Iterable[_MessageSummary], emoji_ids: Set[int]
+    ) -> Tuple[Counter[int], Counter[int]]:
         user_ids = set(self._user_ids)
-        for message in messages:
-            author_matches = not user_ids or message.author.id in user_ids
-            for counter in counters:
-                # メッセージ内に使われているかのカウント
-                if author_matches and counter.emoji.name in message.content:
-                    # BOTを弾く
-                    if self._contains_bot or not message.author.bot:
-                        counter.increment(_EmojiCountType.MESSAGE_CONTENT)
-                # リアクションに使われているかのカウント
-                for reaction in message.reactions:
-                    if not isinstance(reaction.emoji, discord.Emoji):
-                        continue
-                    if reaction.emoji.id != counter.emoji.id:
-                        continue
-                    users = [user async for user in reaction.users()]
-                    if user_ids:
-                        users = [user for user in users if user.id in user_ids]
-                    if not users:
-                        continue
-                    # BOTを弾く
-                    if not self._contains_bot and all(user.bot for user in users):
-                        continue
-                    counter.increment(_EmojiCountType.MESSAGE_REACTION)
-        return counters
+        contains_bot = self._contains_bot
+        # BOTを含めてユーザー指定もなければ、誰が付けたかを見る必要はない
+        count_all_reactions = contains_bot and not user_ids
+        bot_count = self._known_bot_count()
+        # 絵文字IDごとの回数 (集計対象外の絵文字も含むので、参照する側で絞り込む)
+        content_counts: Counter[int] = collections.Counter()
+        reaction_counts: Counter[int] = collections.Counter()
+        for summary in summaries:
+            # メッセージ内に使われているかのカウント(BOTを弾く)
+            if (not user_ids or summary.author_id in user_ids) and (
+                contains_bot or not summary.author_bot
+            ):
+                content_counts.update(summary.emoji_ids)
+            # リアクションに使われているかのカウント
+            if count_all_reactions:
+                reaction_counts.update(summary.reactions.keys())
+                continue
+            reaction_counts.update(
+                emoji_id
+                for emoji_id, reaction in summary.reactions.items()
+                if emoji_id in emoji_ids
+                and (
+                    _exceeds(reaction.count, bot_count)
+                    or reaction.has_user(user_ids, contains_bot)
+                )
+            )
+        return content_counts, reaction_counts
+
+    def _known_bot_count(self) -> Optional[int]:
+        # ユーザー指定がなくBOTの数が分かる場合だけ、リアクション数で判断できる
+        if self._user_ids:
+            return None
+        return self._bot_count
 
     def sort_ranking(
         self, counters: List[_EmojiCounter], slice_num: int
     ) -> List[_EmojiCounter]:
-        # ソートした上で要求された順位までの要素数に切り取る
-        reverse = _SortOrder.reverse(self._order)
-        sorted_counters = sorted(
-            counters, key=lambda c: c.total_count, reverse=reverse
-        )[0:slice_num]
+        # 絵文字数はサーバーの上限(数百)程度なので、ヒープで部分ソートするより
+        # C実装のsortedで全体を並べてから切り取る方が速い
+        key = operator.attrgetter("total_count")
+        if _SortOrder.reverse(self._order):
+            # 一度も使われていない絵文字は上位に入り得ないので先に除外し、
+            # 足りない分だけ元の順序のまま補う
+            used = [c for c in counters if c.total_count > 0]
+            sorted_counters = sorted(used, key=key, reverse=True)[0:slice_num]
+            if len(sorted_counters) < slice_num:
+                unused = (c for c in counters if c.total_count == 0)
+                sorted_counters.extend(
+                    itertools.islice(unused, slice_num - len(sorted_counters))
+                )
+        else:
+            sorted_counters = sorted(counters, key=key)[0:slice_num]
 
         # 同順位を考慮した順位付け
         for index, counter in enumerate(sorted_counters):
@@ -309,6 +805,127 @@ class EmojiRanking(commands.Cog, CogHelper):
 
         return sorted_counters
 
+    # 以降はゲートウェイのイベントで、取得済みの履歴キャッシュを最新に保つ
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        # 再接続で取りこぼしたイベントがあり得るのでキャッシュを捨てる
+        self._histories.clear()
+
+    @commands.Cog.listener()
+    async def on_message(self, message: discord.Message):
+        history = self._histories.get(message.channel.id)
+        if history is None:
+            return
+        history.append(await _MessageSummary.from_message(message, set()))
+
+    @commands.Cog.listener()
+    async def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent):
+        history = self._histories.get(payload.channel_id)
+        if history is None:
+            return
+        history.touch(payload.message_id)
+        if not history.covers(payload.message_id):
+            return
+        if "content" not in payload.data:
+            return
+        summary = history.get(payload.message_id)
+        author = payload.data.get("author")
+        if author is not None:
+            author_id, author_bot = int(author["id"]), author.get("bot", False)
+        elif summary is not None:
+            author_id, author_bot = summary.author_id, summary.author_bot
+        else:
+            return
+        emoji_ids = frozenset(
+            int(match.group(3))
+            for match in _CUSTOM_EMOJI_RE.finditer(payload.data["content"])
+        )
+        reactions = summary.reactions if summary is not None else {}
+        history.add(
+            _MessageSummary(
+                payload.message_id, author_id, author_bot, emoji_ids, reactions
+            )
+        )
+
+    @commands.Cog.listener()
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        history = self._histories.get(payload.channel_id)
+        if history is not None:
+            history.touch(payload.message_id)
+            history.discard(payload.message_id)
+
+    @commands.Cog.listener()
+    async def on_raw_bulk_message_delete(
+        self, payload: discord.RawBulkMessageDeleteEvent
+    ):
+        history = self._histories.get(payload.channel_id)
+        if history is not None:
+            for message_id in payload.message_ids:
+                history.touch(message_id)
+                history.discard(message_id)
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
+        history = self._histories.get(payload.channel_id)
+        if history is None or payload.emoji.id is None:
+            return
+        history.touch(payload.message_id)
+        if not history.covers(payload.message_id):
+            return
+        summary = history.get(payload.message_id)
+        if summary is None:
+            # キャッシュにないメッセージは本文にカスタム絵文字を含まないので投稿者は不要
+            summary = _MessageSummary(payload.message_id, None, False, frozenset(), {})
+        reaction = summary.reactions.get(payload.emoji.id)
+        if reaction is None:
+            reaction = _ReactionSummary(payload.emoji.id, 0, resolved=True)
+            summary.reactions[payload.emoji.id] = reaction
+            history.add(summary)
+        bot = payload.member.bot if payload.member is not None else False
+        reaction.add_user(payload.user_id, bot)
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_remove(self, payload: discord.RawReactionActionEvent):
+        history = self._histories.get(payload.channel_id)
+        if history is None or payload.emoji.id is None:
+            return
+        history.touch(payload.message_id)
+        summary = history.get(payload.message_id)
+        if summary is None or payload.emoji.id not in summary.reactions:
+            return
+        reaction = summary.reactions[payload.emoji.id]
+        reaction.remove_user(payload.user_id)
+        if reaction.count <= 0:
+            del summary.reactions[payload.emoji.id]
+            history.add(summary)
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_clear(self, payload: discord.RawReactionClearEvent):
+        history = self._histories.get(payload.channel_id)
+        if history is None:
+            return
+        history.touch(payload.message_id)
+        summary = history.get(payload.message_id)
+        if summary is None:
+            return
+        summary.reactions.clear()
+        history.add(summary)
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_clear_emoji(
+        self, payload: discord.RawReactionClearEmojiEvent
+    ):
+        history = self._histories.get(payload.channel_id)
+        if history is None:
+            return
+        history.touch(payload.message_id)
+        summary = history.get(payload.message_id)
+        if summary is None or payload.emoji.id not in summary.reactions:
+            return
+        del summary.reactions[payload.emoji.id]
+        history.add(summary)
+
 
 def setup(bot: commands.Bot):
     return bot.add_cog(EmojiRanking(bot))
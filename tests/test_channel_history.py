@@ -0,0 +1,101 @@
+import unittest
+
+from discord_emoji_ranking.module import _ChannelHistory, _MessageSummary
+
+
+def _summary(message_id: int) -> _MessageSummary:
+    return _MessageSummary(message_id, 1, False, frozenset({10}), {})
+
+
+class TestChannelHistory(unittest.TestCase):
+    def test_holes_without_cache(self):
+        history = _ChannelHistory()
+        self.assertEqual(history.holes(0, 1000), [(0, 1000)])
+        self.assertFalse(history.covers(500))
+
+    def test_holes_around_fetched_range(self):
+        history = _ChannelHistory()
+        history.mark_fetched(100, 200)
+        self.assertEqual(history.holes(0, 1000), [(0, 101), (199, 1000)])
+        self.assertEqual(history.holes(150, 180), [])
+        self.assertTrue(history.covers(150))
+        self.assertFalse(history.covers(100))
+        self.assertFalse(history.covers(200))
+
+    def test_mark_fetched_extends_connected_range(self):
+        history = _ChannelHistory()
+        history.mark_fetched(100, 200)
+        history.mark_fetched(199, 300)
+        self.assertEqual(history.holes(0, 300), [(0, 101)])
+
+    def test_mark_fetched_replaces_disconnected_range(self):
+        history = _ChannelHistory()
+        history.mark_fetched(100, 200)
+        history.add(_summary(150))
+        history.mark_fetched(500, 600)
+        self.assertFalse(history.covers(150))
+        self.assertIsNone(history.get(150))
+        self.assertEqual(history.holes(0, 1000), [(0, 501), (599, 1000)])
+
+    def test_append_does_not_extend_over_unfetched_messages(self):
+        history = _ChannelHistory()
+        history.mark_fetched(100, 200)
+        history.append(_summary(10000))
+        self.assertEqual(history.holes(0, 10001), [(0, 101), (199, 10001)])
+        self.assertFalse(history.covers(5000))
+        self.assertFalse(history.covers(10000))
+        self.assertIsNone(history.get(10000))
+
+    def test_append_extends_range_reaching_last_message(self):
+        history = _ChannelHistory()
+        history.mark_fetched(100, 200)
+        history.append(_summary(150))
+        history.append(_summary(300))
+        history.append(_summary(400))
+        self.assertEqual(history.holes(0, 401), [(0, 101)])
+        self.assertEqual(
+            [summary.id for summary in history.messages(0, 401)], [150, 300, 400]
+        )
+
+    def test_add_and_discard(self):
+        history = _ChannelHistory()
+        history.mark_fetched(100, 200)
+        history.add(_summary(150))
+        history.add(_MessageSummary(160, 1, False, frozenset(), {}))
+        self.assertIsNotNone(history.get(150))
+        self.assertIsNone(history.get(160))
+        history.discard(150)
+        self.assertEqual(history.messages(100, 200), [])
+
+    def test_touch_marks_messages_in_fetching_range(self):
+        history = _ChannelHistory()
+        history.begin_fetch(100, 200)
+        history.touch(150)
+        history.touch(250)
+        self.assertEqual(history.pop_dirty(100, 200), [150])
+        self.assertEqual(history.pop_dirty(100, 200), [])
+
+    def test_end_fetch_drops_dirty_messages(self):
+        history = _ChannelHistory()
+        history.begin_fetch(100, 200)
+        history.touch(150)
+        history.end_fetch(100, 200)
+        history.touch(160)
+        self.assertEqual(history.pop_dirty(0, 1000), [])
+
+    def test_trim_drops_oldest_messages_and_shrinks_range(self):
+        history = _ChannelHistory()
+        history.mark_fetched(100, 200)
+        for message_id in (110, 120, 130, 140):
+            history.add(_summary(message_id))
+        history.trim(2)
+        self.assertEqual(
+            [summary.id for summary in history.messages(0, 200)], [130, 140]
+        )
+        self.assertFalse(history.covers(120))
+        self.assertTrue(history.covers(121))
+        self.assertEqual(history.holes(0, 200), [(0, 121)])
+
+
+if __name__ == "__main__":
+    unittest.main()